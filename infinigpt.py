@@ -1,32 +1,69 @@
 import asyncio
+import base64
 import datetime
 import json
 import logging
 import os
-from typing import Dict, List, Optional, Any
+import re
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Optional, Set, Tuple
 
-import jwt
-import requests
+import aiohttp
+import httpx
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from nio import (
     AsyncClient, AsyncClientConfig, MatrixRoom, RoomMessageText,
     LoginResponse, EncryptionError, KeyVerificationStart, KeyVerificationCancel,
     KeyVerificationKey, KeyVerificationMac, ToDeviceError, ToDeviceResponse,
-    InviteMemberEvent
+    InviteMemberEvent, RoomMemberEvent, RoomSendResponse, JoinResponse, SyncResponse
 )
 from nio.store import SqliteStore
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+# Re-sign the JWT once it is this close to expiring
+JWT_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# The header never changes, so it is encoded once
+JWT_HEADER_B64 = _b64url(json.dumps({"alg": "EdDSA", "typ": "JWT"}, separators=(",", ":")).encode())
+
+USER_AGENT = "ai-llm-matrix-bot"
+
+# Keep-alive pool sizes for connections to the XWiki endpoint
+HTTP_POOL_CONNECTIONS = 16
+HTTP_POOL_MAXSIZE = 32
+# Retries for the model list GET, with exponential backoff starting at this many seconds
+MODEL_LIST_RETRIES = 3
+MODEL_LIST_BACKOFF = 0.2
+
+# How long a resolved display name is trusted, in seconds
+DISPLAY_NAME_TTL = 600
+# Most display names kept at once; the least recently used entry is evicted first
+DISPLAY_NAME_CACHE_SIZE = 1024
+# Upper bound on concurrent display name requests issued by a single command
+DISPLAY_NAME_CONCURRENCY = 8
+
+# Number of user/assistant turns kept per conversation, besides the system prompt
+HISTORY_TURNS = 22
+
+# Minimum delay between edits of a streamed reply, in seconds
+STREAM_EDIT_INTERVAL = 1.0
+
+# How long a fetched model list is reused before asking XWiki again, in seconds
+MODEL_LIST_TTL = 60
+
+# Maximum number of chat completions in flight across all rooms
+MAX_CONCURRENT_RESPONSES = 8
+
 class Config:
-    def __init__(self, config_file: str):
-        with open(config_file, 'r') as f:
-            config = json.load(f)
-        
+    def __init__(self, config: List[Dict[str, Any]]):
         self.models = config[0].get('models', [])
         self.restrict_to_specified_models = config[0].get('restrict_to_specified_models', False)
         self.server = config[1]['server']
@@ -38,6 +75,11 @@ class Config:
         self.personality = config[1]['personality']
         self.admins = config[1]['admins']
         self.forbidden_words = config[1].get('forbidden_words', [])
+        self.forbidden_words_lower = [word.lower() for word in self.forbidden_words]
+        # One alternation scans a message in a single pass; None when there is nothing to match
+        self.forbidden_pattern = re.compile(
+            "|".join(map(re.escape, self.forbidden_words_lower))
+        ) if self.forbidden_words_lower else None
         self.default_model = config[1].get('default_model', 'AI.Models.waise-llama3')
         self.jwt_payload = config[1].get('jwt_payload', {})
         self.moderation_enabled = config[1].get('moderation_enabled', True)
@@ -48,20 +90,57 @@ class Config:
         self.auto_join_rooms = config[1].get('auto_join_rooms', True)
 
 class InfiniGPT:
-    def __init__(self):
-        self.config = Config("config.json")
+    def __init__(self, config: List[Dict[str, Any]]):
+        self.config = Config(config)
         self.private_key = self._load_private_key()
+        self._jwt_cache: Dict[str, Tuple[str, datetime.datetime]] = {}
         self.client = self._setup_matrix_client()
+        self._http = aiohttp.ClientSession(
+            headers={"User-Agent": USER_AGENT},
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_MAXSIZE, limit_per_host=HTTP_POOL_CONNECTIONS)
+        )
+        self._openai_http = httpx.AsyncClient(
+            headers={"User-Agent": USER_AGENT},
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAXSIZE,
+                max_keepalive_connections=HTTP_POOL_CONNECTIONS
+            )
+        )
         self.openai = None  # We'll initialize this later
         self.models = []  # We'll populate this later
+        self.model_mapping: Dict[str, str] = {}
+        self._models_cache: Optional[Tuple[float, List[str], Dict[str, str]]] = None
         self.default_model = self.config.default_model
         self.current_model = None  # We'll set this in initialize_openai
         self.join_time = datetime.datetime.now(datetime.timezone.utc)
-        self.messages: Dict[str, Dict[str, List[Dict[str, str]]]] = {}
+        # channel -> sender -> {"system": system message or None, "turns": deque of messages}
+        self.messages: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._dn_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._room_sem: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(1))
+        self._global_sem = asyncio.Semaphore(MAX_CONCURRENT_RESPONSES)
+        self._background_tasks: Set[asyncio.Task] = set()
+        self._joined_rooms: Set[str] = set()  # Filled from the initial sync, kept current by handle_sync
         self.prompt = (
             "assume the personality of ",
             ".  roleplay and never break character. keep your responses relatively short."
         )
+        # Shared by every conversation using the default personality; never mutate it
+        self._system_prompt_str = self.prompt[0] + self.config.personality + self.prompt[1]
+        self._default_system_msg = {"role": "system", "content": self._system_prompt_str}
+        self._help_text = self._load_help_text()
+        # command -> (requires an argument, handler(room_id, sender, args))
+        self._handlers: Dict[str, Tuple[bool, Callable[[str, str, str], Awaitable[None]]]] = {
+            ".ai": (True, self._handle_ai_command),
+            ".x": (True, self._handle_x_command),
+            ".persona": (True, self._handle_persona_command),
+            ".custom": (True, self._handle_custom_command),
+            ".model": (False, self._handle_model_command),
+            ".models": (False, self._handle_models_command),
+            ".reset": (False, self._handle_reset_command),
+            ".stock": (False, self._handle_stock_command),
+            ".help": (False, self._handle_help_command),
+            ".reloadhelp": (False, self._handle_reloadhelp_command),
+        }
 
     def _load_private_key(self):
         with open("private.pem", "rb") as key_file:
@@ -71,6 +150,14 @@ class InfiniGPT:
                 backend=default_backend()
             )
 
+    def _load_help_text(self) -> Optional[str]:
+        try:
+            with open("help.txt", "r") as f:
+                return f.read()
+        except OSError as e:
+            logger.error(f"Error loading help file: {e}")
+            return None
+
     def _setup_matrix_client(self):
         store_path = "nio_store/"
         os.makedirs(store_path, exist_ok=True)
@@ -88,22 +175,55 @@ class InfiniGPT:
 
     def _generate_jwt(self, username: str) -> str:
         current_time = datetime.datetime.now(datetime.timezone.utc)
+        cached = self._jwt_cache.get(username)
+        if cached and cached[1] - current_time > JWT_REFRESH_MARGIN:
+            return cached[0]
+
+        expiration = current_time + datetime.timedelta(hours=self.config.jwt_expiration_hours)
         payload = self.config.jwt_payload.copy()
         payload.update({
             "sub": username,
-            "exp": current_time + datetime.timedelta(hours=self.config.jwt_expiration_hours),
-            "iat": current_time,
-            "nbf": current_time,
+            "exp": int(expiration.timestamp()),
+            "iat": int(current_time.timestamp()),
+            "nbf": int(current_time.timestamp()),
         })
-        return jwt.encode(payload, self.private_key, algorithm="EdDSA")
-
-    def model_list(self) -> List[str]:
+        # Build the compact JWS by hand: the key is already loaded, so signing is a single Ed25519 call
+        signing_input = JWT_HEADER_B64 + b"." + _b64url(json.dumps(payload, separators=(",", ":")).encode())
+        signature = self.private_key.sign(signing_input)
+        token = (signing_input + b"." + _b64url(signature)).decode()
+        self._jwt_cache[username] = (token, expiration)
+        return token
+
+    def _current_jwt(self) -> str:
+        """Return the bot's JWT, re-signing it only when it is about to expire."""
+        return self._generate_jwt(self.config.matrix_username)
+
+    def _refresh_openai_auth(self):
+        # The OpenAI client reads api_key for every request, so swapping it here
+        # is enough to pick up a renewed token.
+        self.openai.api_key = self._current_jwt()
+
+    async def _get_models_json(self) -> Any:
+        for attempt in range(MODEL_LIST_RETRIES + 1):
+            try:
+                jwt_token = self._current_jwt()
+                headers = {"Authorization": f"Bearer {jwt_token}"}
+                async with self._http.get(f"{self.config.xwiki_endpoint}/models", headers=headers) as response:
+                    response.raise_for_status()
+                    return await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Client errors such as 401 or a wrong content type will not fix themselves
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status >= 500
+                if attempt == MODEL_LIST_RETRIES or not retryable:
+                    raise
+                logger.warning(f"Error fetching models, retrying: {e}")
+                await asyncio.sleep(MODEL_LIST_BACKOFF * 2 ** attempt)
+
+    async def model_list(self, force: bool = False) -> List[str]:
+        if not force and self._models_cache and time.monotonic() - self._models_cache[0] < MODEL_LIST_TTL:
+            return self._models_cache[1]
         try:
-            jwt_token = self._generate_jwt(self.config.matrix_username)
-            headers = {"Authorization": f"Bearer {jwt_token}"}
-            response = requests.get(f"{self.config.xwiki_endpoint}/models", headers=headers)
-            response.raise_for_status()
-            data = response.json()
+            data = await self._get_models_json()
             available_models = [model['name'] for model in data['data']]
             
             if self.config.restrict_to_specified_models:
@@ -114,20 +234,25 @@ class InfiniGPT:
             
             self.model_mapping = {model['name']: model['id'] for model in data['data'] if model['name'] in models}
             self.models = models  # Update the instance variable
+            self._models_cache = (time.monotonic(), models, self.model_mapping)
             return models
-        except requests.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Error fetching models: {e}")
-            return self.config.models if self.config.restrict_to_specified_models else []
-        except KeyError as e:
+        except (KeyError, TypeError, ValueError) as e:
+            # ValueError covers a malformed JSON body, TypeError a body of the wrong shape
             logger.error(f"Unexpected response format when fetching models: {e}")
-            return self.config.models if self.config.restrict_to_specified_models else []
+        # Keep serving the last list that was fetched successfully, if there is one
+        if self.models:
+            return self.models
+        return self.config.models if self.config.restrict_to_specified_models else []
 
-    def initialize_openai(self, api_key: str):
-        self.openai = OpenAI(
+    async def initialize_openai(self, api_key: str):
+        self.openai = AsyncOpenAI(
             api_key=api_key,
-            base_url=self.config.xwiki_endpoint
+            base_url=self.config.xwiki_endpoint,
+            http_client=self._openai_http
         )
-        available_models = self.model_list()  # This now updates self.models
+        available_models = await self.model_list()  # This now updates self.models
         if available_models:
             if self.default_model not in available_models:
                 logger.warning(f"Default model {self.default_model} not available. Using first available model.")
@@ -142,74 +267,177 @@ class InfiniGPT:
         self.current_model = model_id
 
     async def display_name(self, user: str) -> Optional[str]:
+        cached = self._dn_cache.get(user)
+        if cached:
+            if time.monotonic() - cached[1] < DISPLAY_NAME_TTL:
+                self._dn_cache.move_to_end(user)
+                return cached[0]
+            del self._dn_cache[user]
         try:
             name = await self.client.get_displayname(user)
+            if name.displayname is not None:
+                self._dn_cache[user] = (name.displayname, time.monotonic())
+                if len(self._dn_cache) > DISPLAY_NAME_CACHE_SIZE:
+                    self._dn_cache.popitem(last=False)
             return name.displayname
         except Exception as e:
             logger.error(f"Error getting display name: {e}")
             return None
 
-    async def send_message(self, channel: str, message: str):
+    async def send_message(self, channel: str, message: str) -> Optional[str]:
         try:
-            await self.client.room_send(
+            response = await self.client.room_send(
                 room_id=channel,
                 message_type="m.room.message",
                 content={"msgtype": "m.text", "body": message},
                 ignore_unverified_devices=True,
             )
+            if isinstance(response, RoomSendResponse):
+                return response.event_id
+            logger.error(f"Error sending message: {response}")
         except Exception as e:
             logger.error(f"Error sending message: {e}")
+        return None
+
+    async def edit_message(self, channel: str, event_id: str, message: str) -> bool:
+        try:
+            response = await self.client.room_send(
+                room_id=channel,
+                message_type="m.room.message",
+                content={
+                    "msgtype": "m.text",
+                    "body": f"* {message}",
+                    "m.new_content": {"msgtype": "m.text", "body": message},
+                    "m.relates_to": {"rel_type": "m.replace", "event_id": event_id},
+                },
+                ignore_unverified_devices=True,
+            )
+            if isinstance(response, RoomSendResponse):
+                return True
+            logger.error(f"Error editing message: {response}")
+        except Exception as e:
+            logger.error(f"Error editing message: {e}")
+        return False
+
+    async def _post_or_edit(self, channel: str, event_id: Optional[str], message: str) -> Optional[str]:
+        if event_id is None:
+            return await self.send_message(channel, message)
+        await self.edit_message(channel, event_id, message)
+        return event_id
 
     async def moderate(self, message: str) -> bool:
         if not self.config.moderation_enabled:
             return False
         
         if self.config.moderation_strategy == 'forbidden_words':
-            return any(word.lower() in message.lower() for word in self.config.forbidden_words)
+            pattern = self.config.forbidden_pattern
+            return pattern is not None and pattern.search(message.lower()) is not None
         else:
             logger.warning(f"Unknown moderation strategy: {self.config.moderation_strategy}")
             return False
 
+    def _new_conversation(self, system: Optional[Dict[str, str]]) -> Dict[str, Any]:
+        return {"system": system, "turns": deque(maxlen=HISTORY_TURNS)}
+
+    def history(self, channel: str, sender: str) -> List[Dict[str, str]]:
+        conversation = self.messages[channel][sender]
+        system = conversation["system"]
+        return ([system] if system else []) + list(conversation["turns"])
+
+    def _clear_history(self, channel: str, sender: str):
+        conversation = self.messages[channel][sender]
+        conversation["system"] = None
+        conversation["turns"].clear()
+
     async def add_history(self, role: str, channel: str, sender: str, message: str):
         if channel not in self.messages:
             self.messages[channel] = {}
         
         if sender not in self.messages[channel]:
-            self.messages[channel][sender] = [
-                {"role": "system", "content": self.prompt[0] + self.config.personality + self.prompt[1]},
-                {"role": role, "content": message}
-            ]
-        else:
-            self.messages[channel][sender].append({"role": role, "content": message})
+            self.messages[channel][sender] = self._new_conversation(self._default_system_msg)
 
-    async def respond(self, channel: str, sender: str, message: List[Dict[str, str]], sender2: Optional[str] = None):
-        try:
-            if not self.current_model:
-                logger.error("No model selected. Using default model.")
-                self.current_model = self.default_model
-
-            response = self.openai.chat.completions.create(
-                model=self.current_model,
-                temperature=self.config.response_temperature,
-                messages=message
-            )
-            response_text = response.choices[0].message.content.strip('"')
-            await self.add_history("assistant", channel, sender, response_text)
-            
-            display_name = await self.display_name(sender2 or sender)
-            response_text = f"{display_name}:\n{response_text}"
-            
-            await self.send_message(channel, response_text)
+        conversation = self.messages[channel][sender]
+        if role == "system":
+            if message == self._system_prompt_str:
+                conversation["system"] = self._default_system_msg
+            else:
+                conversation["system"] = {"role": role, "content": message}
+        else:
+            turns = conversation["turns"]
+            if len(turns) == turns.maxlen:
+                turns.popleft()
+                # Evict whole exchanges: a reply whose question just went goes with it, so the
+                # history never starts on an orphaned assistant turn
+                if turns and turns[0]["role"] == "assistant":
+                    turns.popleft()
+            turns.append({"role": role, "content": message})
+
+    def _spawn(self, coro: Coroutine[Any, Any, None]):
+        # The event loop only keeps weak references to tasks, so hold one until it finishes
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _serialized(self, channel: str, func: Callable[..., Awaitable[None]], *args: Any):
+        # History changes queue behind the replies already waiting on this room
+        async with self._room_sem[channel]:
+            await func(*args)
+
+    async def respond(
+        self, channel: str, sender: str, sender_display: str,
+        user_message: Optional[str] = None, system_prompt: Optional[str] = None
+    ):
+        # Handlers spawn this as a task so nio can carry on with the sync response;
+        # completions run one at a time per room, with a cap across all rooms
+        async with self._room_sem[channel], self._global_sem:
+            # Change the history and snapshot it only once the room is ours,
+            # so a queued request sees the reply to the one before it
+            if system_prompt is not None:
+                await self.custom(channel, sender, system_prompt)
+            if user_message is not None:
+                await self.add_history("user", channel, sender, user_message)
+            message = self.history(channel, sender)
+            try:
+                if not self.current_model:
+                    logger.error("No model selected. Using default model.")
+                    self.current_model = self.default_model
+
+                self._refresh_openai_auth()
+
+                stream = await self.openai.chat.completions.create(
+                    model=self.current_model,
+                    temperature=self.config.response_temperature,
+                    messages=message,
+                    stream=True
+                )
+                loop = asyncio.get_running_loop()
+                parts: List[str] = []
+                event_id = None
+                sent_text = None
+                last_edit = loop.time()
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                    if parts and loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+                        sent_text = f"{sender_display}:\n" + "".join(parts).strip('"')
+                        event_id = await self._post_or_edit(channel, event_id, sent_text)
+                        last_edit = loop.time()
+
+                response_text = "".join(parts).strip('"')
+                await self.add_history("assistant", channel, sender, response_text)
             
-            if len(self.messages[channel][sender]) > 24:
-                del self.messages[channel][sender][1:3]
-        except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            await self.send_message(channel, "An error occurred while generating a response. Please try again later.")
+                response_text = f"{sender_display}:\n{response_text}"
+                if response_text != sent_text:
+                    # The final edit is what delivers the full reply, so post it fresh if the edit fails
+                    if event_id is None or not await self.edit_message(channel, event_id, response_text):
+                        await self.send_message(channel, response_text)
+            except Exception as e:
+                logger.error(f"Error generating response: {e}")
+                await self.send_message(channel, "An error occurred while generating a response. Please try again later.")
 
     async def persona(self, channel: str, sender: str, persona: str):
         try:
-            self.messages[channel][sender].clear()
+            self._clear_history(channel, sender)
         except KeyError:
             pass
         personality = self.prompt[0] + persona + self.prompt[1]
@@ -217,7 +445,7 @@ class InfiniGPT:
 
     async def custom(self, channel: str, sender: str, prompt: str):
         try:
-            self.messages[channel][sender].clear()
+            self._clear_history(channel, sender)
         except KeyError:
             pass
         await self.add_history("system", channel, sender, prompt)
@@ -234,83 +462,87 @@ class InfiniGPT:
         if message_time <= self.join_time or sender == self.config.matrix_username:
             return
 
-        try:
-            sender_display = await self.display_name(sender)
-        except Exception as e:
-            logger.error(f"Error getting display name for {sender}: {e}")
-            sender_display = sender
-
-        if message.startswith(".ai ") or message.startswith(self.client.user_id):
-            await self._handle_ai_command(room_id, sender, sender_display, message)
-        elif message.startswith(".x "):
-            await self._handle_x_command(room_id, sender, sender_display, message)
-        elif message.startswith(".persona "):
-            await self._handle_persona_command(room_id, sender, sender_display, message)
-        elif message.startswith(".custom "):
-            await self._handle_custom_command(room_id, sender, sender_display, message)
-        elif message.startswith(".model"):
-            await self._handle_model_command(room_id, sender, sender_display, message)
-        elif message.startswith(".reset"):
-            await self._handle_reset_command(room_id, sender, sender_display)
-        elif message.startswith(".stock"):
-            await self._handle_stock_command(room_id, sender, sender_display)
-        elif message.startswith(".help"):
-            await self._handle_help_command(room_id, sender_display)
-
-    async def _handle_ai_command(self, room_id: str, sender: str, sender_display: str, message: str):
-        m = message.split(" ", 1)[1]
-        flagged = await self.moderate(m)
+        # Split off the command word once; anything that is not a command or a mention is dropped here
+        command, _, rest = message.partition(" ")
+        is_mention = message.startswith(self.client.user_id)
+        if command not in self._handlers and not is_mention:
+            return
+
+        if is_mention:
+            # Mentions are handled like .ai, with the bot's name as the command word
+            needs_rest, handler = True, self._handle_ai_command
+        else:
+            needs_rest, handler = self._handlers[command]
+
+        if needs_rest and not rest:
+            return
+        # Handlers resolve the sender's display name themselves, and only when they print it
+        await handler(room_id, sender, rest)
+
+    async def _sender_display(self, sender: str) -> str:
+        # display_name logs and returns None on failure; show the raw user id instead
+        return await self.display_name(sender) or sender
+
+    async def _handle_ai_command(self, room_id: str, sender: str, args: str):
+        flagged, sender_display = await asyncio.gather(self.moderate(args), self._sender_display(sender))
         if flagged:
             await self.send_message(room_id, f"{sender_display}: This message violates the usage policy and was not sent.")
         else:
-            await self.add_history("user", room_id, sender, m)
-            await self.respond(room_id, sender, self.messages[room_id][sender])
-
-    async def _handle_x_command(self, room_id: str, sender: str, sender_display: str, message: str):
-        m = message.split(" ", 2)
-        if len(m) > 2:
-            disp_name, m = m[1], m[2]
-            name_id = ""
+            self._spawn(self.respond(room_id, sender, sender_display, args))
+
+    async def _handle_x_command(self, room_id: str, sender: str, args: str):
+        m = args.split(" ", 1)
+        if len(m) > 1:
+            disp_name, m = m[0], m[1]
             if room_id in self.messages:
-                for user in self.messages[room_id]:
-                    try:
-                        matrix_username = await self.display_name(user)
-                        if disp_name == matrix_username:
-                            name_id = user
-                    except Exception as e:
-                        logger.error(f"Error getting display name for {user}: {e}")
-                        name_id = disp_name
+                users = list(self.messages[room_id])
+                sem = asyncio.Semaphore(DISPLAY_NAME_CONCURRENCY)
+
+                async def _resolve(user: str):
+                    async with sem:
+                        return user, await self.display_name(user)
+
+                pairs, flagged, sender_display = await asyncio.gather(
+                    asyncio.gather(*[_resolve(user) for user in users]),
+                    self.moderate(m),
+                    self._sender_display(sender)
+                )
+                name_id = next((user for user, name in pairs if name == disp_name), disp_name)
                 
-                flagged = await self.moderate(m)
                 if flagged:
                     await self.send_message(room_id, f"{sender_display}: This message violates the usage policy and was not sent.")
                 else:
-                    await self.add_history("user", room_id, name_id, m)
-                    await self.respond(room_id, name_id, self.messages[room_id][name_id], sender)
+                    self._spawn(self.respond(room_id, name_id, sender_display, m))
 
-    async def _handle_persona_command(self, room_id: str, sender: str, sender_display: str, message: str):
-        m = message.split(" ", 1)[1]
-        flagged = await self.moderate(m)
+    async def _handle_persona_command(self, room_id: str, sender: str, args: str):
+        flagged, sender_display = await asyncio.gather(self.moderate(args), self._sender_display(sender))
         if flagged:
             await self.send_message(room_id, f"{sender_display}: This persona violates the usage policy and was not set. Choose a new persona.")
         else:
-            await self.persona(room_id, sender, m)
-            await self.respond(room_id, sender, self.messages[room_id][sender])
+            personality = self.prompt[0] + args + self.prompt[1]
+            self._spawn(self.respond(room_id, sender, sender_display, system_prompt=personality))
 
-    async def _handle_custom_command(self, room_id: str, sender: str, sender_display: str, message: str):
-        m = message.split(" ", 1)[1]
-        flagged = await self.moderate(m)
+    async def _handle_custom_command(self, room_id: str, sender: str, args: str):
+        flagged, sender_display = await asyncio.gather(self.moderate(args), self._sender_display(sender))
         if flagged:
             await self.send_message(room_id, f"{sender_display}: This custom prompt violates the usage policy and was not set.")
         else:
-            await self.custom(room_id, sender, m)
-            await self.respond(room_id, sender, self.messages[room_id][sender])
-
-    async def _handle_model_command(self, room_id: str, sender: str, sender_display: str, message: str):
-        if message == ".model" or message == ".models":
-            await self.send_message(room_id, f"Current model: {self.current_model}\nAvailable models: " + ", ".join(self.models))
-        elif message.startswith(".model ") and sender in self.config.admins:
-            model_name = message.split(" ", 1)[1]
+            self._spawn(self.respond(room_id, sender, sender_display, system_prompt=args))
+
+    async def _send_model_list(self, room_id: str):
+        models = await self.model_list()
+        await self.send_message(room_id, f"Current model: {self.current_model}\nAvailable models: " + ", ".join(models))
+
+    async def _handle_models_command(self, room_id: str, sender: str, args: str):
+        # Listing only; changing the model goes through .model <name>
+        if not args:
+            await self._send_model_list(room_id)
+
+    async def _handle_model_command(self, room_id: str, sender: str, args: str):
+        if not args:
+            await self._send_model_list(room_id)
+        elif sender in self.config.admins:
+            model_name = args
             if model_name in self.model_mapping:
                 model_id = self.model_mapping[model_name]
                 self.change_model(model_id)
@@ -318,38 +550,64 @@ class InfiniGPT:
             elif model_name == "reset":
                 self.change_model(self.default_model)
                 await self.send_message(room_id, f"Model set to {self.default_model}")
+            elif model_name == "refresh":
+                previous = self._models_cache
+                models = await self.model_list(force=True)
+                if self._models_cache is previous:
+                    # model_list only replaces the cache on a successful fetch
+                    await self.send_message(room_id, "Failed to refresh the model list. Try again later.")
+                else:
+                    await self.send_message(room_id, "Available models: " + ", ".join(models))
             else:
                 await self.send_message(room_id, "Invalid model name. Try again.")
 
-    async def _handle_reset_command(self, room_id: str, sender: str, sender_display: str):
-            if room_id in self.messages and sender in self.messages[room_id]:
-                self.messages[room_id][sender].clear()
-                await self.persona(room_id, sender, self.config.personality)
-            await self.send_message(room_id, f"{self.client.user_id} reset to default for {sender_display}")
+    async def _handle_reset_command(self, room_id: str, sender: str, args: str):
+        self._spawn(self._serialized(room_id, self.reset, room_id, sender))
+
+    async def _handle_stock_command(self, room_id: str, sender: str, args: str):
+        self._spawn(self._serialized(room_id, self.stock, room_id, sender))
 
-    async def _handle_stock_command(self, room_id: str, sender: str, sender_display: str):
+    async def reset(self, room_id: str, sender: str):
+        if room_id in self.messages and sender in self.messages[room_id]:
+            await self.persona(room_id, sender, self.config.personality)
+        sender_display = await self._sender_display(sender)
+        await self.send_message(room_id, f"{self.client.user_id} reset to default for {sender_display}")
+
+    async def stock(self, room_id: str, sender: str):
         if room_id in self.messages:
             if sender in self.messages[room_id]:
-                self.messages[room_id][sender].clear()
+                self._clear_history(room_id, sender)
         else:
             self.messages[room_id] = {}
-            self.messages[room_id][sender] = []
+            self.messages[room_id][sender] = self._new_conversation(None)
+        sender_display = await self._sender_display(sender)
         await self.send_message(room_id, f"Stock settings applied for {sender_display}")
 
-    async def _handle_help_command(self, room_id: str, sender_display: str):
-        try:
-            with open("help.txt", "r") as f:
-                help_text = f.read()
-            await self.send_message(room_id, help_text)
-        except Exception as e:
-            logger.error(f"Error loading help file: {e}")
+    async def _handle_help_command(self, room_id: str, sender: str, args: str):
+        if self._help_text is not None:
+            await self.send_message(room_id, self._help_text)
+        else:
+            sender_display = await self._sender_display(sender)
             await self.send_message(room_id, f"{sender_display}: An error occurred while loading the help file. Please try again later.")
 
+    async def _handle_reloadhelp_command(self, room_id: str, sender: str, args: str):
+        if sender in self.config.admins:
+            self._help_text = self._load_help_text()
+            status = "reloaded" if self._help_text is not None else "could not be loaded"
+            sender_display = await self._sender_display(sender)
+            await self.send_message(room_id, f"{sender_display}: Help file {status}.")
+
     async def join_rooms(self):
         for room_id in self.config.channels:
+            if room_id in self._joined_rooms:
+                continue
             try:
-                await self.client.join(room_id)
-                logger.info(f"Joined room {room_id}")
+                response = await self.client.join(room_id)
+                if isinstance(response, JoinResponse):
+                    self._joined_rooms.add(response.room_id)
+                    logger.info(f"Joined room {room_id}")
+                else:
+                    logger.error(f"Failed to join room {room_id}: {response}")
             except Exception as e:
                 logger.error(f"Failed to join room {room_id}: {e}")
 
@@ -359,13 +617,26 @@ class InfiniGPT:
 
         if self.config.auto_join_rooms or room.room_id in self.config.channels:
             try:
-                await self.client.join(room.room_id)
-                logger.info(f"Joined room {room.room_id} after invitation")
+                response = await self.client.join(room.room_id)
+                if isinstance(response, JoinResponse):
+                    self._joined_rooms.add(response.room_id)
+                    logger.info(f"Joined room {room.room_id} after invitation")
+                else:
+                    logger.error(f"Failed to join room {room.room_id} after invitation: {response}")
             except Exception as e:
                 logger.error(f"Failed to join room {room.room_id} after invitation: {e}")
         else:
             logger.info(f"Ignored invitation to room {room.room_id} as it's not in the configured channels and auto-join is disabled")
 
+    async def handle_member(self, room: MatrixRoom, event: RoomMemberEvent):
+        # Membership events carry display name changes, so drop the stale entry
+        self._dn_cache.pop(event.state_key, None)
+
+    async def handle_sync(self, response: SyncResponse):
+        # nio runs no event callbacks for the leave section, so a kick or ban is only visible here
+        self._joined_rooms.update(response.rooms.join.keys())
+        self._joined_rooms.difference_update(response.rooms.leave.keys())
+
     async def periodic_room_check(self):
         while True:
             await asyncio.sleep(300)  # Check every 5 minutes
@@ -380,18 +651,21 @@ class InfiniGPT:
             return
 
         await self.client.sync(full_state=True, timeout=30000)
+        self._joined_rooms = set(self.client.rooms.keys())
 
         self.client.user_id = await self.display_name(self.config.matrix_username)
 
-        # Join configured rooms
+        # Join configured rooms the bot is not already in
         await self.join_rooms()
 
         # Set up callbacks
         self.client.add_event_callback(self.message_callback, RoomMessageText)
         self.client.add_event_callback(self.handle_invite, InviteMemberEvent)
+        self.client.add_event_callback(self.handle_member, RoomMemberEvent)
+        self.client.add_response_callback(self.handle_sync, SyncResponse)
 
         # Start periodic room check
-        asyncio.create_task(self.periodic_room_check())
+        self._spawn(self.periodic_room_check())
 
         # Set up verification callbacks
         self.client.add_to_device_callback(self.verification_start, KeyVerificationStart)
@@ -401,6 +675,15 @@ class InfiniGPT:
 
         await self.client.sync_forever(timeout=self.config.sync_timeout)
 
+    async def close(self):
+        for task in self._background_tasks:
+            task.cancel()
+        # Let cancelled tasks unwind while the HTTP sessions they use are still open
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self._http.close()
+        await self._openai_http.aclose()
+        await self.client.close()
+
     async def verification_start(self, event):
         """Handle verification start event."""
         logger.info(f"Verification started: {event}")
@@ -450,24 +733,26 @@ class InfiniGPT:
         except Exception as e:
             logger.error(f"Error canceling verification: {e}")
 
-def get_matrix_username():
-    config_file = "config.json"
-    with open(config_file) as f:
-        config = json.load(f)
-        return config[1]['matrix_username']
+def load_config(config_file: str = "config.json") -> List[Dict[str, Any]]:
+    with open(config_file, 'r') as f:
+        return json.load(f)
 
 async def main():
-    matrix_username = get_matrix_username()
-    
-    infinigpt = InfiniGPT()
-    
-    jwt_token = infinigpt._generate_jwt(matrix_username)
+    config = load_config()
+    matrix_username = config[1]['matrix_username']
     
-    os.environ['OPENAI_API_KEY'] = jwt_token
+    infinigpt = InfiniGPT(config)
     
-    infinigpt.initialize_openai(jwt_token)
-    
-    await infinigpt.main()
+    try:
+        jwt_token = infinigpt._generate_jwt(matrix_username)
+        
+        os.environ['OPENAI_API_KEY'] = jwt_token
+        
+        await infinigpt.initialize_openai(jwt_token)
+        
+        await infinigpt.main()
+    finally:
+        await infinigpt.close()
 
 if __name__ == "__main__":
     asyncio.get_event_loop().run_until_complete(main())
\ No newline at end of file